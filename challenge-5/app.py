@@ -7,6 +7,65 @@ ALLOWED_CATEGORIES = {"Employment", "General Information", "Emergency Services",
 GEN_CONFIG_DETERMINISTIC = GenerationConfig(temperature=0.0, top_p=1.0, max_output_tokens=256)
 GEN_CONFIG_POSTS = GenerationConfig(temperature=0.2, top_p=0.95, max_output_tokens=256)
 
+CLASSIFY_PROMPT = """
+Classify the question into EXACTLY one of these labels:
+Employment
+General Information
+Emergency Services
+Tax Related
+
+Rules:
+- Output ONLY the exact label text above.
+- No extra words, punctuation, or explanation.
+
+Question: {question}
+Output:
+""".strip()
+
+CLASSIFY_BATCH_PROMPT = """
+Classify each numbered question into EXACTLY one of these labels:
+Employment
+General Information
+Emergency Services
+Tax Related
+
+Rules:
+- Return exactly {n} lines, one per question, in the same order.
+- Each line is ONLY the exact label text above.
+- No numbering, extra words, punctuation, or explanation.
+
+Questions:
+{questions}
+Output:
+""".strip()
+
+ANNOUNCEMENT_PROMPT = """
+Write ONE professional government social media post.
+
+Rules:
+- Max 200 characters
+- MUST include the exact phrase: "Check for updates"
+- Output ONLY the post text
+
+Topic: {topic}
+Post:
+""".strip()
+
+# Shortened labels the model sometimes returns
+CATEGORY_ALIASES = {"Emergency": "Emergency Services", "Tax": "Tax Related", "Taxes": "Tax Related"}
+
+# Wording swapped in when a prompt comes back empty (likely safety-blocked)
+SOFTEN_MAP = {
+    "Emergency alert": "Public notice",
+    "boil-water": "water advisory",
+    "gas": "odor",
+    "fire": "urgent situation",
+}
+_SOFTEN_RE = re.compile("|".join(map(re.escape, SOFTEN_MAP)))
+
+_WS_RE = re.compile(r"\s+")
+_LIST_PREFIX_RE = re.compile(r"^\s*(?:\d+[.):]|[-*])\s*")
+
 def init_model(project_id: str, location: str = "us-central1", model_name: str = "gemini-2.5-flash"):
     vertexai.init(project=project_id, location=location)
     return GenerativeModel(model_name)
@@ -46,56 +105,54 @@ def _generate_text_with_retry(model, prompt: str, generation_config: GenerationC
         return out
 
     # Retry once with slightly safer phrasing
-    softened = (
-        prompt.replace("Emergency alert", "Public notice")
-              .replace("boil-water", "water advisory")
-              .replace("gas", "odor")
-              .replace("fire", "urgent situation")
-    )
+    softened = _SOFTEN_RE.sub(lambda m: SOFTEN_MAP[m.group(0)], prompt)
     resp2 = model.generate_content(softened, generation_config=generation_config)
     return _safe_text(resp2)
 
 def classify_question(model, question: str) -> str:
-    prompt = f"""
-Classify the question into EXACTLY one of these labels:
-Employment
-General Information
-Emergency Services
-Tax Related
-
-Rules:
-- Output ONLY the exact label text above.
-- No extra words, punctuation, or explanation.
-
-Question: {question}
-Output:
-""".strip()
+    prompt = CLASSIFY_PROMPT.format(question=question)
 
-    out = _generate_text_with_retry(model, prompt, GEN_CONFIG_DETERMINISTIC)
-    out = out.replace(".", "").strip()
-
-    # normalize common shortenings
-    out = {"Emergency": "Emergency Services", "Tax": "Tax Related", "Taxes": "Tax Related"}.get(out, out)
+    out = _normalize_label(_generate_text_with_retry(model, prompt, GEN_CONFIG_DETERMINISTIC))
 
     if out not in ALLOWED_CATEGORIES:
         raise ValueError(f"Unexpected category: {out!r}")
     return out
 
-def generate_announcement(model, topic: str) -> str:
-    prompt = f"""
-Write ONE professional government social media post.
+def classify_questions(model, questions: list[str]) -> list[str]:
+    """
+    Classifies many questions with one model call.
+    Rows whose label is missing or invalid fall back to classify_question.
+    """
+    if not questions:
+        return []
 
-Rules:
-- Max 200 characters
-- MUST include the exact phrase: "Check for updates"
-- Output ONLY the post text
+    numbered = "\n".join(f"{i}. {q}" for i, q in enumerate(questions, 1))
+    prompt = CLASSIFY_BATCH_PROMPT.format(n=len(questions), questions=numbered)
+    out = _generate_text_with_retry(model, prompt, GEN_CONFIG_DETERMINISTIC)
 
-Topic: {topic}
-Post:
-""".strip()
+    lines = [ln for ln in out.splitlines() if ln.strip()]
+    # A short/long list can't be aligned to the questions, so retry everything
+    if len(lines) != len(questions):
+        lines = [""] * len(questions)
+
+    labels = []
+    for question, line in zip(questions, lines):
+        label = _normalize_label(_LIST_PREFIX_RE.sub("", line))
+        if label not in ALLOWED_CATEGORIES:
+            label = classify_question(model, question)
+        labels.append(label)
+    return labels
+
+def _normalize_label(out: str) -> str:
+    out = out.replace(".", "").strip()
+    # normalize common shortenings
+    return CATEGORY_ALIASES.get(out, out)
+
+def generate_announcement(model, topic: str) -> str:
+    prompt = ANNOUNCEMENT_PROMPT.format(topic=topic)
 
     post = _generate_text_with_retry(model, prompt, GEN_CONFIG_POSTS)
-    post = re.sub(r"\s+", " ", post).strip()
+    post = _WS_RE.sub(" ", post).strip()
 
     # Hard enforcement for deterministic tests
     if "check for updates" not in post.lower():
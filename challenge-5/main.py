@@ -1,15 +1,32 @@
+import asyncio
+import json
 import uuid
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
-from pydantic import BaseModel
-from fastapi.responses import HTMLResponse
+from pydantic import BaseModel, ConfigDict, Field
+from fastapi.responses import HTMLResponse, StreamingResponse
 
 import rag_service
 
-app = FastAPI(title="Alaska Department of Snow - Online Agent")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    rag_service.start_local_index_load()
+    # Best-effort; never hold up startup (and readiness probes) on slow backends
+    warmup = asyncio.create_task(rag_service.warmup())
+    yield
+    warmup.cancel()
+    # Push any buffered chat logs to BigQuery before the worker exits
+    await asyncio.to_thread(rag_service.flush_logs)
+
+app = FastAPI(title="Alaska Department of Snow - Online Agent", lifespan=lifespan)
 
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     message: str
-    top_k: int = 10
+    # Bounded here so bad values get a 422 instead of a BigQuery/index error
+    top_k: int = Field(10, ge=1, le=50)
     session_id: str | None = None
 
 class ChatResponse(BaseModel):
@@ -24,9 +41,11 @@ def health():
     return {"status": "ok"}
 
 @app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
+async def chat(req: ChatRequest, nocache: bool = False):
     sid = req.session_id or str(uuid.uuid4())
-    out = rag_service.guarded_rag_chat(req.message, top_k=req.top_k, session_id=sid)
+    out = await rag_service.guarded_rag_chat(
+        req.message, top_k=req.top_k, session_id=sid, use_cache=not nocache
+    )
     return {
         "session_id": out["session_id"],
         "blocked": bool(out.get("blocked", False)),
@@ -35,6 +54,22 @@ def chat(req: ChatRequest):
         "issues": out.get("issues", ""),
     }
 
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, nocache: bool = False):
+    """Server-sent events: `data:` lines carry answer text, then one `event: done`."""
+    sid = req.session_id or str(uuid.uuid4())
+
+    async def events():
+        async for event, data in rag_service.guarded_rag_chat_stream(
+            req.message, top_k=req.top_k, session_id=sid, use_cache=not nocache
+        ):
+            if event == "delta":
+                yield "".join(f"data: {line}\n" for line in data.split("\n")) + "\n"
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @app.get("/", response_class=HTMLResponse)
 def home():
     return rag_service.html_page()
@@ -1,14 +1,32 @@
 import os
+import asyncio
 import json
 import re
 import datetime
-from typing import List, Dict, Any
-
+import hashlib
+import logging
+import queue
+import string
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List, Dict, Any, NamedTuple, Optional
+
+import google.auth
+import numpy as np
+import requests
 import vertexai
 from vertexai.generative_models import GenerativeModel, GenerationConfig
 from vertexai.language_models import TextEmbeddingModel
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery
 
+try:
+    import hyperscan
+except ImportError:  # no prebuilt wheel for this platform; prompt_filter falls back to re
+    hyperscan = None
+
 
 # ========================
 # Config / Environment
@@ -21,6 +39,47 @@ LOG_TABLE_ID = os.environ.get("LOG_TABLE_ID")  # e.g. myproj.ads_logs.chat_logs
 
 MODEL_NAME = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
 EMBED_MODEL = os.environ.get("EMBED_MODEL", "text-embedding-005")
+# Optional BigQuery remote model over EMBED_MODEL (e.g. myproj.ads_rag.embed_model).
+# When set, uncached queries are embedded inside the VECTOR_SEARCH job itself.
+BQ_EMBED_MODEL_ID = os.environ.get("BQ_EMBED_MODEL_ID")
+
+VECTOR_INDEX_NAME = os.environ.get("VECTOR_INDEX_NAME", "chunks_embedding_idx")
+# DOT_PRODUCT is only equivalent to COSINE once the corpus is unit-length
+# (see normalize_corpus_embeddings); rebuild the vector index after switching.
+VECTOR_DISTANCE_TYPE = os.environ.get("VECTOR_DISTANCE_TYPE", "COSINE").upper()
+VECTOR_INDEX_TYPE = os.environ.get("VECTOR_INDEX_TYPE", "TREE_AH").upper()  # TREE_AH | IVF
+VECTOR_INDEX_NUM_LISTS = int(os.environ.get("VECTOR_INDEX_NUM_LISTS", "256"))  # IVF only
+# Share of index partitions probed per query (the "nprobe" recall/latency knob)
+VECTOR_SEARCH_FRACTION_LISTS = float(os.environ.get("VECTOR_SEARCH_FRACTION_LISTS", "0.05"))
+
+# Optional in-process index over the whole corpus:
+# "" = off, "hnsw" = approximate (hnswlib), "numpy" = exact matmul over an mmap.
+LOCAL_INDEX = os.environ.get("LOCAL_INDEX", "").lower()
+LOCAL_INDEX_PATH = os.environ.get("LOCAL_INDEX_PATH", "/tmp/ads_rag_embeddings.f32")
+HNSW_M = int(os.environ.get("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF = int(os.environ.get("HNSW_EF", "100"))  # must stay >= top_k
+
+# Keep-alive connections per worker; should cover the threads that call BigQuery
+# concurrently (asyncio.to_thread + log writer), or connections get discarded.
+BQ_HTTP_POOL_SIZE = int(os.environ.get("BQ_HTTP_POOL_SIZE", "32"))
+
+# Max characters of retrieved chunk text packed into the Gemini prompt
+CONTEXT_BUDGET_CHARS = int(os.environ.get("CONTEXT_BUDGET_CHARS", "8000"))
+
+# Optional per-query cost cap for every BigQuery job this service runs
+BQ_MAX_BYTES_BILLED = os.environ.get("BQ_MAX_BYTES_BILLED")
+
+# Query embeddings are coalesced across concurrent requests into one RPC.
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "32"))
+EMBED_BATCH_WINDOW_S = float(os.environ.get("EMBED_BATCH_WINDOW_MS", "10")) / 1000.0
+
+# In-process caches for repeated questions (0 disables).
+CACHE_SIZE = int(os.environ.get("RAG_CACHE_SIZE", "2048"))
+
+# Chat logs are buffered and streamed to BigQuery off the request path.
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "500"))
+LOG_FLUSH_INTERVAL_S = float(os.environ.get("LOG_FLUSH_INTERVAL_S", "2"))
 
 if not PROJECT_ID:
     raise RuntimeError("GOOGLE_CLOUD_PROJECT not set.")
@@ -28,31 +87,71 @@ if not RAG_TABLE_ID:
     raise RuntimeError("RAG_TABLE_ID env var not set (e.g. PROJECT.ads_rag.chunks).")
 if not LOG_TABLE_ID:
     raise RuntimeError("LOG_TABLE_ID env var not set (e.g. PROJECT.ads_logs.chat_logs).")
+if LOCAL_INDEX not in ("", "hnsw", "numpy"):
+    raise RuntimeError(f"LOCAL_INDEX must be empty, 'hnsw' or 'numpy', got {LOCAL_INDEX!r}.")
+if VECTOR_DISTANCE_TYPE not in ("COSINE", "DOT_PRODUCT"):
+    raise RuntimeError(f"VECTOR_DISTANCE_TYPE must be COSINE or DOT_PRODUCT, got {VECTOR_DISTANCE_TYPE!r}.")
+if VECTOR_INDEX_TYPE not in ("TREE_AH", "IVF"):
+    raise RuntimeError(f"VECTOR_INDEX_TYPE must be TREE_AH or IVF, got {VECTOR_INDEX_TYPE!r}.")
 
 
 # ========================
 # Clients (Vertex + BQ)
 # ========================
 vertexai.init(project=PROJECT_ID, location=LOCATION)
-bq = bigquery.Client(project=PROJECT_ID)
+# Per-call QueryJobConfigs only carry parameters; these defaults are merged in
+_bq_defaults = bigquery.QueryJobConfig(
+    use_query_cache=True,
+    priority=bigquery.QueryPriority.INTERACTIVE,
+)
+if BQ_MAX_BYTES_BILLED:
+    _bq_defaults.maximum_bytes_billed = int(BQ_MAX_BYTES_BILLED)
+_bq_credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+_bq_http = AuthorizedSession(_bq_credentials)
+_bq_http.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(pool_connections=BQ_HTTP_POOL_SIZE, pool_maxsize=BQ_HTTP_POOL_SIZE),
+)
+bq = bigquery.Client(
+    project=PROJECT_ID,
+    credentials=_bq_credentials,
+    _http=_bq_http,
+    default_query_job_config=_bq_defaults,
+)
+
+# Static instructions go in the system instruction so every request shares the
+# same prompt prefix.
+SYSTEM_PROMPT = """
+You are the Alaska Department of Snow online assistant.
+Use ONLY the context provided with each question.
 
-gemini = GenerativeModel(MODEL_NAME)
+Requirements:
+- If the answer is not in the context, say exactly:
+  "I don't have enough information in the provided documents."
+- Add inline citations like [doc_path#chunk_id] after each key fact.
+- Write 2–6 sentences. End with a complete sentence.
+""".strip()
+
+gemini = GenerativeModel(MODEL_NAME, system_instruction=SYSTEM_PROMPT)
 embed_model = TextEmbeddingModel.from_pretrained(EMBED_MODEL)
 
 GEN_ANS = GenerationConfig(temperature=0.2, top_p=0.95, max_output_tokens=768)
+GEN_ANS_RETRY = GenerationConfig(temperature=0.2, max_output_tokens=1024)
 
 CITE_RE = re.compile(r"\[[^\]]+#\d+\]")
 
+logger = logging.getLogger(__name__)
+
 
 # ========================
 # Helpers
 # ========================
-def safe_text(resp) -> str:
+def safe_text(resp, strip: bool = True) -> str:
     """Safely extract text from Gemini response without crashing on .text."""
     try:
         t = getattr(resp, "text", None)
         if t:
-            return t.strip()
+            return t.strip() if strip else t
     except Exception:
         pass
 
@@ -61,29 +160,218 @@ def safe_text(resp) -> str:
         if not cands:
             return ""
         parts = getattr(getattr(cands[0], "content", None), "parts", None) or []
-        return "".join([getattr(p, "text", "") for p in parts]).strip()
+        t = "".join([getattr(p, "text", "") for p in parts])
+        return t.strip() if strip else t
     except Exception:
         return ""
 
 
+def unit_vector(vec) -> np.ndarray:
+    v = np.asarray(vec, dtype=np.float32)
+    return v / max(float(np.linalg.norm(v)), 1e-12)
+
+
 def embed_texts(texts: List[str]) -> List[List[float]]:
-    embs = embed_model.get_embeddings(texts)
-    return [e.values for e in embs]
+    """Embed texts in as few RPCs as possible (EMBED_BATCH_SIZE per call)."""
+    out: List[List[float]] = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        embs = embed_model.get_embeddings(texts[i:i + EMBED_BATCH_SIZE])
+        out.extend(e.values for e in embs)
+    return out
 
 
-def retrieve_top_chunks(query: str, top_k: int = 10):
-    q_vec = embed_texts([query])[0]
-    sql = f"""
-    SELECT base.doc_uri, base.doc_path, base.chunk_id, base.chunk_text, distance
-    FROM VECTOR_SEARCH(
-      TABLE `{RAG_TABLE_ID}`,
-      'embedding',
-      (SELECT @qvec AS embedding),
-      top_k => @topk
-    )
+class _LRUCache:
+    """Small thread-safe LRU map; maxsize <= 0 disables caching."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Embeddings are deterministic, so vectors are keyed by the exact query text.
+_qvec_cache = _LRUCache(CACHE_SIZE)
+# Validated answers are keyed by the normalized question (see answer_cache_key).
+_answer_cache = _LRUCache(CACHE_SIZE)
+
+_PUNCT_TABLE = str.maketrans("", "", string.punctuation)
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase, strip punctuation and collapse whitespace."""
+    return " ".join((question or "").lower().translate(_PUNCT_TABLE).split())
+
+
+def answer_cache_key(question: str, top_k: int) -> str:
+    digest = hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()
+    return f"{digest}:{int(top_k)}"
+
+
+class _EmbedBatcher:
+    """
+    Micro-batches single-query embeddings from concurrent request threads.
+
+    Callers block on a per-request Future; a daemon worker waits up to
+    EMBED_BATCH_WINDOW_S for more queries, then issues one embed RPC for
+    up to EMBED_BATCH_SIZE of them and fans the vectors back out.
     """
-    job = bq.query(
-        sql,
+
+    def __init__(self):
+        self._queue: "queue.Queue[tuple[str, Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+
+    def embed(self, text: str) -> List[float]:
+        self._ensure_worker()
+        fut: Future = Future()
+        self._queue.put((text, fut))
+        return fut.result()
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # The window is fixed from the first arrival, not extended per arrival
+            deadline = time.monotonic() + EMBED_BATCH_WINDOW_S
+            while len(batch) < EMBED_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                vecs = embed_texts([text for text, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), vec in zip(batch, vecs):
+                fut.set_result(vec)
+
+
+_embed_batcher = _EmbedBatcher()
+
+
+def embed_query(query: str, use_cache: bool = True) -> List[float]:
+    if use_cache:
+        q_vec = _qvec_cache.get(query)
+        if q_vec is not None:
+            return q_vec
+    q_vec = _embed_batcher.embed(query)
+    _qvec_cache.put(query, q_vec)
+    return q_vec
+
+
+def retrieve_top_chunks(
+    query: str,
+    top_k: int = 10,
+    q_vec: Optional[List[float]] = None,
+    use_cache: bool = True,
+):
+    local = _local_index
+    if local is not None:
+        if q_vec is None:
+            q_vec = embed_query(query, use_cache=use_cache)
+        return local.search(q_vec, top_k)
+
+    if q_vec is None and use_cache:
+        q_vec = _qvec_cache.get(query)
+    if q_vec is None and BQ_EMBED_MODEL_ID:
+        return _vector_search_text(query, top_k)
+    if q_vec is None:
+        q_vec = embed_query(query, use_cache=use_cache)
+    return _vector_search(q_vec, top_k)
+
+
+_SEARCH_OPTIONS = json.dumps({"fraction_lists_to_search": VECTOR_SEARCH_FRACTION_LISTS})
+
+# Both searches differ only in where the query embedding comes from
+_VECTOR_SEARCH_SQL = """
+SELECT base.doc_uri, base.doc_path, base.chunk_id, base.chunk_text, distance
+FROM VECTOR_SEARCH(
+  TABLE `{table}`,
+  'embedding',
+  ({query_embedding}),
+  top_k => @topk,
+  distance_type => '{distance_type}',
+  options => '{options}'
+)
+"""
+
+VECTOR_SEARCH_SQL = _VECTOR_SEARCH_SQL.format(
+    table=RAG_TABLE_ID,
+    query_embedding="SELECT @qvec AS embedding",
+    distance_type=VECTOR_DISTANCE_TYPE,
+    options=_SEARCH_OPTIONS,
+)
+
+# Unit-length copy of an ARRAY<FLOAT64> expression; the norm is computed once
+# per array and a zero vector stays all zeros instead of failing the query.
+_UNIT_ARRAY_SQL = """(
+  SELECT ARRAY(
+    SELECT IFNULL(SAFE_DIVIDE(x, n), 0)
+    FROM UNNEST({arr}) AS x WITH OFFSET AS pos
+    ORDER BY pos
+  )
+  FROM (SELECT SQRT(SUM(y * y)) AS n FROM UNNEST({arr}) AS y)
+)"""
+
+_GENERATED_EMBEDDING = (
+    _UNIT_ARRAY_SQL.format(arr="ml_generate_embedding_result")
+    if VECTOR_DISTANCE_TYPE == "DOT_PRODUCT"
+    else "ml_generate_embedding_result"
+)
+
+VECTOR_SEARCH_TEXT_SQL = _VECTOR_SEARCH_SQL.format(
+    table=RAG_TABLE_ID,
+    query_embedding=f"""
+    SELECT {_GENERATED_EMBEDDING} AS embedding
+    FROM ML.GENERATE_EMBEDDING(
+      MODEL `{BQ_EMBED_MODEL_ID}`,
+      (SELECT @q AS content),
+      STRUCT(TRUE AS flatten_json_output)
+    )
+  """,
+    distance_type=VECTOR_DISTANCE_TYPE,
+    options=_SEARCH_OPTIONS,
+)
+
+
+def _vector_search(q_vec: List[float], top_k: int):
+    if VECTOR_DISTANCE_TYPE == "DOT_PRODUCT":
+        q_vec = unit_vector(q_vec).tolist()
+    rows = bq.query_and_wait(
+        VECTOR_SEARCH_SQL,
         job_config=bigquery.QueryJobConfig(
             query_parameters=[
                 bigquery.ArrayQueryParameter("qvec", "FLOAT64", q_vec),
@@ -91,7 +379,37 @@ def retrieve_top_chunks(query: str, top_k: int = 10):
             ]
         ),
     )
-    return list(job.result())
+    return list(rows)
+
+
+def _vector_search_text(query: str, top_k: int):
+    """Embed + search in one BigQuery job via ML.GENERATE_EMBEDDING."""
+    rows = bq.query_and_wait(
+        VECTOR_SEARCH_TEXT_SQL,
+        job_config=bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("q", "STRING", query),
+                bigquery.ScalarQueryParameter("topk", "INT64", top_k),
+            ]
+        ),
+    )
+    return list(rows)
+
+
+def pack_hits(hits, budget: int = CONTEXT_BUDGET_CHARS) -> list:
+    """Keep hits in rank order until their chunk text would exceed the budget."""
+    packed, used = [], 0
+    for r in hits:
+        used += len(r.chunk_text or "")
+        # The top hit always goes in, even if it alone is over budget
+        if packed and used > budget:
+            break
+        packed.append(r)
+
+    dropped = len(hits) - len(packed)
+    if dropped:
+        logger.info("context budget %d chars: dropped %d of %d chunks", budget, dropped, len(hits))
+    return packed
 
 
 def build_context(hits) -> str:
@@ -103,22 +421,193 @@ def build_context(hits) -> str:
 
 
 # ========================
-# RAG Answer
+# Vector Index (admin)
+# ========================
+def create_vector_index(replace: bool = False):
+    """
+    One-off step after (re)loading RAG_TABLE_ID:
+        python -c "import rag_service; rag_service.create_vector_index()"
+
+    TREE_AH (ScaNN, default) keeps product-quantized codes of the
+    embeddings, scans those instead of the FLOAT64 arrays, and re-ranks its
+    candidates with exact distances. IVF partitions the vectors into
+    VECTOR_INDEX_NUM_LISTS clusters. Either way a query only probes
+    VECTOR_SEARCH_FRACTION_LISTS of the partitions. BigQuery only
+    populates the index once the table has 5,000+ rows; smaller tables
+    keep using brute force.
+    """
+    create = "CREATE OR REPLACE VECTOR INDEX" if replace else "CREATE VECTOR INDEX IF NOT EXISTS"
+    options = f"index_type = '{VECTOR_INDEX_TYPE}', distance_type = '{VECTOR_DISTANCE_TYPE}'"
+    if VECTOR_INDEX_TYPE == "IVF":
+        ivf_options = json.dumps({"num_lists": VECTOR_INDEX_NUM_LISTS})
+        options += f", ivf_options = '{ivf_options}'"
+    ddl = f"""
+    {create} `{VECTOR_INDEX_NAME}`
+    ON `{RAG_TABLE_ID}`(embedding)
+    STORING (doc_uri, doc_path, chunk_id, chunk_text)
+    OPTIONS ({options})
+    """
+    bq.query_and_wait(ddl)
+
+
+def normalize_corpus_embeddings():
+    """
+    One-off step before VECTOR_DISTANCE_TYPE=DOT_PRODUCT: rescale every
+    stored embedding to unit length so the dot product equals cosine
+    similarity without a per-row norm.
+    """
+    bq.query_and_wait(f"""
+    UPDATE `{RAG_TABLE_ID}` AS t
+    SET embedding = {_UNIT_ARRAY_SQL.format(arr="t.embedding")}
+    WHERE ARRAY_LENGTH(t.embedding) > 0
+    """)
+
+
 # ========================
-def rag_answer(question: str, top_k: int = 10) -> Dict[str, Any]:
-    hits = retrieve_top_chunks(question, top_k=top_k)
-    context = build_context(hits)
+# Local Index (optional)
+# ========================
+class Hit(NamedTuple):
+    """Same fields as a VECTOR_SEARCH row, for hits served in-process."""
+    doc_uri: str
+    doc_path: str
+    chunk_id: int
+    chunk_text: str
+    distance: float
+
+
+class _HNSWIndex:
+    def __init__(self, rows: List[Hit], embeddings: np.ndarray):
+        import hnswlib  # optional; only needed with LOCAL_INDEX=hnsw
+
+        self.rows = rows
+        self.index = hnswlib.Index(space="cosine", dim=embeddings.shape[1])
+        self.index.init_index(max_elements=len(rows), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        self.index.add_items(embeddings, np.arange(len(rows)))
+        self.index.set_ef(HNSW_EF)
+
+    def search(self, q_vec: List[float], top_k: int) -> List[Hit]:
+        k = min(top_k, len(self.rows))
+        labels, dists = self.index.knn_query(np.asarray(q_vec, dtype=np.float32), k=k)
+        return [
+            self.rows[i]._replace(distance=float(d))
+            for i, d in zip(labels[0], dists[0])
+        ]
+
+
+class _NumpyIndex:
+    """
+    Exact cosine search over one contiguous (N, D) float32 matrix.
 
-    prompt = f"""
-You are the Alaska Department of Snow online assistant.
-Use ONLY the context below.
+    Rows are L2-normalized once and written to LOCAL_INDEX_PATH, then
+    memory-mapped read-only, so a query is a single BLAS mat-vec plus an
+    argpartition. (float16 would halve the bytes, but numpy has no fp16
+    BLAS path, so the matmul would get slower, not faster.)
 
-Requirements:
-- If the answer is not in the context, say exactly:
-  "I don't have enough information in the provided documents."
-- Add inline citations like [doc_path#chunk_id] after each key fact.
-- Write 2–6 sentences. End with a complete sentence.
+    A "<path>.sha1" sidecar fingerprints the corpus the file was built
+    from; workers and restarts that load the same corpus map the existing
+    file instead of rewriting it.
+    """
+
+    def __init__(self, rows: List[Hit], embeddings: np.ndarray):
+        self.rows = rows
+        fingerprint = self._fingerprint(rows, embeddings)
+        key_path = f"{LOCAL_INDEX_PATH}.sha1"
+
+        if not self._is_current(key_path, fingerprint, embeddings.shape):
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            normalized = embeddings / np.maximum(norms, 1e-12)
+
+            # Write-then-rename so workers loading concurrently never map a
+            # half-written file; the sidecar only moves once the data is in place.
+            tmp_path = f"{LOCAL_INDEX_PATH}.{os.getpid()}.tmp"
+            mm = np.memmap(tmp_path, dtype=np.float32, mode="w+", shape=normalized.shape)
+            mm[:] = normalized
+            mm.flush()
+            del mm
+            os.replace(tmp_path, LOCAL_INDEX_PATH)
+
+            with open(f"{key_path}.{os.getpid()}.tmp", "w") as f:
+                f.write(fingerprint)
+            os.replace(f"{key_path}.{os.getpid()}.tmp", key_path)
+
+        self.embeddings = np.memmap(LOCAL_INDEX_PATH, dtype=np.float32, mode="r", shape=embeddings.shape)
+
+    @staticmethod
+    def _fingerprint(rows: List[Hit], embeddings: np.ndarray) -> str:
+        h = hashlib.sha1(repr(embeddings.shape).encode("utf-8"))
+        for r in rows:
+            h.update(f"{r.doc_path}#{r.chunk_id}\n".encode("utf-8"))
+        h.update(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def _is_current(key_path: str, fingerprint: str, shape) -> bool:
+        try:
+            with open(key_path) as f:
+                if f.read() != fingerprint:
+                    return False
+            return os.path.getsize(LOCAL_INDEX_PATH) == shape[0] * shape[1] * 4
+        except OSError:
+            return False
+
+    def search(self, q_vec: List[float], top_k: int) -> List[Hit]:
+        scores = self.embeddings @ unit_vector(q_vec)
+
+        k = min(top_k, len(self.rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.rows[i]._replace(distance=float(1.0 - scores[i])) for i in top]
+
+
+_LOCAL_INDEX_TYPES = {"hnsw": _HNSWIndex, "numpy": _NumpyIndex}
+
+# None until load_local_index() finishes; retrieval uses BigQuery meanwhile
+_local_index: Optional[Any] = None
+
+
+def load_local_index():
+    """Pull every chunk + embedding from RAG_TABLE_ID and build the in-process index."""
+    global _local_index
+    if not LOCAL_INDEX:
+        return
+
+    # Stable row order, so the numpy index file can be reused across loads
+    sql = f"""
+    SELECT doc_uri, doc_path, chunk_id, chunk_text, embedding
+    FROM `{RAG_TABLE_ID}`
+    ORDER BY doc_path, chunk_id
+    """
+    rows, embs = [], []
+    for r in bq.query_and_wait(sql):
+        rows.append(Hit(r.doc_uri, r.doc_path, int(r.chunk_id), r.chunk_text, 0.0))
+        embs.append(r.embedding)
+    if not rows:
+        logger.warning("local index not built: %s is empty", RAG_TABLE_ID)
+        return
+
+    _local_index = _LOCAL_INDEX_TYPES[LOCAL_INDEX](rows, np.asarray(embs, dtype=np.float32))
+    logger.info("local %s index ready (%d chunks)", LOCAL_INDEX, len(rows))
+
+
+def start_local_index_load():
+    """Build the local index in the background so startup isn't blocked."""
+    if not LOCAL_INDEX:
+        return
 
+    def _load():
+        try:
+            load_local_index()
+        except Exception:
+            logger.exception("local index load failed; staying on BigQuery VECTOR_SEARCH")
+
+    threading.Thread(target=_load, name="local-index-load", daemon=True).start()
+
+
+# ========================
+# RAG Answer
+# ========================
+# Only the per-request part; the static instructions live in SYSTEM_PROMPT
+RAG_PROMPT = """
 User question:
 {question}
 
@@ -128,34 +617,87 @@ Context:
 Answer:
 """.strip()
 
-    resp = gemini.generate_content(prompt, generation_config=GEN_ANS)
+
+async def rag_answer(question: str, top_k: int = 10, use_cache: bool = True) -> Dict[str, Any]:
+    # BigQuery (and the embed batcher) are blocking clients; Gemini has a native async API
+    hits = await asyncio.to_thread(retrieve_top_chunks, question, top_k=top_k, use_cache=use_cache)
+    context_hits = pack_hits(hits)
+    context = build_context(context_hits)
+
+    prompt = RAG_PROMPT.format(question=question, context=context)
+
+    resp = await gemini.generate_content_async(prompt, generation_config=GEN_ANS)
     ans = safe_text(resp)
 
     # Retry once if empty/truncated
     if (not ans) or (ans and ans[-1] not in ".!?"):
-        resp2 = gemini.generate_content(
-            prompt,
-            generation_config=GenerationConfig(temperature=0.2, max_output_tokens=1024),
-        )
+        resp2 = await gemini.generate_content_async(prompt, generation_config=GEN_ANS_RETRY)
         ans2 = safe_text(resp2)
         if ans2:
             ans = ans2
 
-    retrieved_meta = [
+    return {"answer": ans, "retrieved": retrieved_meta(hits, len(context_hits))}
+
+
+def retrieved_meta(hits, in_context: int) -> List[Dict[str, Any]]:
+    """Per-hit log metadata; in_context marks the hits that fit the context budget."""
+    return [
         {
             "doc_path": r.doc_path,
             "chunk_id": int(r.chunk_id),
             "distance": float(r.distance),
+            "in_context": i < in_context,
         }
-        for r in hits
+        for i, r in enumerate(hits)
     ]
 
-    return {"answer": ans, "retrieved": retrieved_meta}
-
 
 # ========================
 # Guardrails (FIXED)
 # ========================
+BLOCKED_PHRASES = (
+    # weapons/explosives/violence
+    "how to build a bomb", "make a bomb", "explosive", "molotov",
+    "how to kill", "kill someone", "murder", "shoot", "stab",
+    # self-harm
+    "suicide", "kill myself", "self harm",
+    # illegal / sabotage
+    "sabotage", "disable a plow", "destroy", "poison", "ricin",
+    "steal", "hack", "bypass", "jailbreak",
+)
+
+# One alternation scans the query once instead of once per phrase
+_BLOCK_RE = re.compile("|".join(map(re.escape, BLOCKED_PHRASES)))
+
+# Hyperscan compiles the same phrases into one SIMD literal matcher.
+# Scratch space is not shareable across threads, so each thread gets its own.
+if hyperscan is not None:
+    _BLOCK_DB = hyperscan.Database()
+    _BLOCK_DB.compile(
+        expressions=[re.escape(p).encode("utf-8") for p in BLOCKED_PHRASES],
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * len(BLOCKED_PHRASES),
+    )
+    _block_scratch = threading.local()
+
+
+def _stop_scan(*_args) -> bool:
+    return True  # first match is enough; terminates the scan
+
+
+def _is_blocked(q: str) -> bool:
+    if hyperscan is None:
+        return _BLOCK_RE.search(q) is not None
+
+    scratch = getattr(_block_scratch, "scratch", None)
+    if scratch is None:
+        scratch = _block_scratch.scratch = hyperscan.Scratch(_BLOCK_DB)
+    try:
+        _BLOCK_DB.scan(q.encode("utf-8"), match_event_handler=_stop_scan, scratch=scratch)
+    except hyperscan.ScanTerminated:
+        return True
+    return False
+
+
 def prompt_filter(user_query: str) -> Dict[str, str]:
     """
     Deterministic safety gate so we NEVER block everything
@@ -166,31 +708,25 @@ def prompt_filter(user_query: str) -> Dict[str, str]:
     """
     q = (user_query or "").lower().strip()
 
-    blocked_phrases = [
-        # weapons/explosives/violence
-        "how to build a bomb", "make a bomb", "explosive", "molotov",
-        "how to kill", "kill someone", "murder", "shoot", "stab",
-        # self-harm
-        "suicide", "kill myself", "self harm",
-        # illegal / sabotage
-        "sabotage", "disable a plow", "destroy", "poison", "ricin",
-        "steal", "hack", "bypass", "jailbreak",
-    ]
-
-    if any(p in q for p in blocked_phrases):
+    if _is_blocked(q):
         return {"decision": "BLOCK", "reason": "Unsafe or illegal request."}
 
     return {"decision": "ALLOW", "reason": "Looks safe."}
 
 
+NO_INFO_ANSWER = "I don't have enough information in the provided documents."
+
+
 def validate_answer(answer: str) -> Dict[str, Any]:
     issues = []
-    if not answer or len(answer.strip()) < 5:
+    text = (answer or "").strip()
+    if len(text) < 5:
         issues.append("empty_or_too_short")
 
-    # Require citations unless explicitly no-info response
-    if answer.strip() != "I don't have enough information in the provided documents.":
-        if not CITE_RE.search(answer):
+    # Require citations unless explicitly no-info response.
+    # Substring checks rule out most uncited answers before the regex runs.
+    if text != NO_INFO_ANSWER:
+        if "[" not in text or "#" not in text or not CITE_RE.search(text):
             issues.append("missing_citations")
 
     return {"valid": len(issues) == 0, "issues": ", ".join(issues) if issues else ""}
@@ -220,17 +756,101 @@ def log_chat(
         "answer_valid": bool(validation["valid"]),
         "answer_issues": validation.get("issues", ""),
     }
-    bq.insert_rows_json(LOG_TABLE_ID, [row])
+    _log_writer.write(row)
+
+
+class _LogWriter:
+    """
+    Buffers chat log rows and streams them to LOG_TABLE_ID from a daemon
+    thread, flushing every LOG_BATCH_SIZE rows or LOG_FLUSH_INTERVAL_S.
+
+    write() only enqueues, so log_chat is safe to call on the event loop;
+    the blocking insert_rows_json call stays on the writer thread, and
+    close() can drain the buffer from the shutdown hook's thread.
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+
+    def write(self, row: Dict[str, Any]):
+        self._ensure_worker()
+        self._queue.put_nowait(row)
+
+    def close(self, timeout: float = 10.0):
+        """Flush everything still buffered and stop the worker."""
+        with self._lock:
+            worker, self._worker = self._worker, None
+        if worker is None:
+            return
+        self._queue.put(self._STOP)
+        worker.join(timeout)
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="chat-log-writer", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL_S
+            while len(batch) < LOG_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, rows: List[Dict[str, Any]]):
+        try:
+            errors = bq.insert_rows_json(LOG_TABLE_ID, rows)
+            if errors:
+                logger.warning("chat log insert reported errors: %s", errors)
+        except Exception:
+            logger.exception("chat log insert failed (%d rows dropped)", len(rows))
+
+
+_log_writer = _LogWriter()
+
+
+def flush_logs():
+    _log_writer.close()
 
 
 # ========================
 # Main Chat Orchestrator
 # ========================
-def guarded_rag_chat(user_query: str, top_k: int = 10, session_id: str = "") -> Dict[str, Any]:
+BLOCKED_ANSWER = "Sorry—I can’t help with that request."
+
+
+async def guarded_rag_chat(
+    user_query: str,
+    top_k: int = 10,
+    session_id: str = "",
+    use_cache: bool = True,
+) -> Dict[str, Any]:
     gate = prompt_filter(user_query)
 
     if gate["decision"] == "BLOCK":
-        answer = "Sorry—I can’t help with that request."
+        answer = BLOCKED_ANSWER
         validation = {"valid": True, "issues": ""}
         log_chat(session_id, user_query, gate, top_k, [], answer, validation)
         return {
@@ -241,16 +861,32 @@ def guarded_rag_chat(user_query: str, top_k: int = 10, session_id: str = "") ->
             "issues": "",
         }
 
-    out = rag_answer(user_query, top_k=top_k)
-    answer = out["answer"]
-    validation = validate_answer(answer)
-
-    # One retry if missing citations
-    if (not validation["valid"]) and ("missing_citations" in validation["issues"]):
-        out = rag_answer(user_query + " (Include citations like [doc_path#chunk_id].)", top_k=top_k)
+    # Repeated questions skip embedding, retrieval and generation entirely
+    cache_key = answer_cache_key(user_query, top_k)
+    cached = _answer_cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        out = cached
+        answer = out["answer"]
+        validation = {"valid": True, "issues": ""}
+    else:
+        out = await rag_answer(user_query, top_k=top_k, use_cache=use_cache)
         answer = out["answer"]
         validation = validate_answer(answer)
 
+        # One retry if missing citations
+        if (not validation["valid"]) and ("missing_citations" in validation["issues"]):
+            out = await rag_answer(
+                user_query + " (Include citations like [doc_path#chunk_id].)",
+                top_k=top_k,
+                use_cache=use_cache,
+            )
+            answer = out["answer"]
+            validation = validate_answer(answer)
+
+        # Only validated answers are worth serving again
+        if validation["valid"]:
+            _answer_cache.put(cache_key, out)
+
     log_chat(session_id, user_query, gate, top_k, out["retrieved"], answer, validation)
 
     return {
@@ -262,6 +898,75 @@ def guarded_rag_chat(user_query: str, top_k: int = 10, session_id: str = "") ->
     }
 
 
+async def guarded_rag_chat_stream(
+    user_query: str,
+    top_k: int = 10,
+    session_id: str = "",
+    use_cache: bool = True,
+):
+    """
+    Streaming variant of guarded_rag_chat.
+
+    Yields ("delta", text) as Gemini produces tokens, then one
+    ("done", {...}) with the validation result. Validation and logging run
+    once generation ends, including when the client disconnects early.
+    """
+    gate = prompt_filter(user_query)
+
+    if gate["decision"] == "BLOCK":
+        validation = {"valid": True, "issues": ""}
+        log_chat(session_id, user_query, gate, top_k, [], BLOCKED_ANSWER, validation)
+        yield "delta", BLOCKED_ANSWER
+        yield "done", {"session_id": session_id, "blocked": True, **validation}
+        return
+
+    cache_key = answer_cache_key(user_query, top_k)
+    cached = _answer_cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        validation = {"valid": True, "issues": ""}
+        log_chat(session_id, user_query, gate, top_k, cached["retrieved"], cached["answer"], validation)
+        yield "delta", cached["answer"]
+        yield "done", {"session_id": session_id, "blocked": False, **validation}
+        return
+
+    parts: List[str] = []
+    retrieved: List[Dict[str, Any]] = []
+    try:
+        hits = await asyncio.to_thread(retrieve_top_chunks, user_query, top_k=top_k, use_cache=use_cache)
+        context_hits = pack_hits(hits)
+        retrieved = retrieved_meta(hits, len(context_hits))
+        prompt = RAG_PROMPT.format(question=user_query, context=build_context(context_hits))
+
+        stream = await gemini.generate_content_async(prompt, generation_config=GEN_ANS, stream=True)
+        async for chunk in stream:
+            t = safe_text(chunk, strip=False)
+            if t:
+                parts.append(t)
+                yield "delta", t
+    finally:
+        answer = "".join(parts).strip()
+        validation = validate_answer(answer)
+        log_chat(session_id, user_query, gate, top_k, retrieved, answer, validation)
+
+    if validation["valid"]:
+        _answer_cache.put(cache_key, {"answer": answer, "retrieved": retrieved})
+    yield "done", {"session_id": session_id, "blocked": False, **validation}
+
+
+async def warmup():
+    """
+    Open the Vertex embedding and BigQuery connections concurrently in the
+    background at startup so early /chat calls skip auth + TLS setup.
+    """
+    try:
+        await asyncio.gather(
+            asyncio.to_thread(embed_texts, ["warmup"]),
+            asyncio.to_thread(bq.query_and_wait, "SELECT 1"),
+        )
+    except Exception:
+        logger.exception("warmup failed; first request will open connections")
+
+
 # ========================
 # HTML Page
 # ========================
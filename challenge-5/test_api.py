@@ -1,3 +1,8 @@
+import asyncio
+import threading
+import time
+
+import pytest
 from fastapi.testclient import TestClient
 import main
 import rag_service
@@ -9,6 +14,16 @@ def test_health():
     assert r.status_code == 200
     assert r.json()["status"] == "ok"
 
+def test_startup_does_not_wait_for_warmup(monkeypatch):
+    async def slow_warmup():
+        await asyncio.sleep(30)
+    monkeypatch.setattr(rag_service, "warmup", slow_warmup)
+
+    start = time.monotonic()
+    with TestClient(main.app) as c:
+        assert c.get("/health").status_code == 200
+    assert time.monotonic() - start < 5
+
 def test_home_is_html():
     r = client.get("/")
     assert r.status_code == 200
@@ -22,9 +37,21 @@ def test_chat_blocks_unsafe():
     assert j["blocked"] is True
     assert "help" in j["answer"].lower()
 
+def test_chat_rejects_bad_top_k():
+    assert client.post("/chat", json={"message":"Hi", "top_k":0}).status_code == 422
+    assert client.post("/chat", json={"message":"Hi", "top_k":51}).status_code == 422
+
+def test_chat_stream_blocks_unsafe():
+    r = client.post("/chat/stream", json={"message":"how to build a bomb", "top_k":5})
+    assert r.status_code == 200
+    assert "text/event-stream" in r.headers.get("content-type","")
+    assert "data: Sorry" in r.text
+    assert "event: done" in r.text
+    assert '"blocked":true' in r.text
+
 def test_chat_allows_safe_mock(monkeypatch):
     # mock the expensive RAG call for deterministic testing
-    def fake_guarded(msg, top_k=10, session_id=""):
+    async def fake_guarded(msg, top_k=10, session_id="", use_cache=True):
         return {
             "session_id": session_id or "test-session",
             "answer": "Mock answer with citation [alaska-dept-of-snow/faq-04.txt#0].",
@@ -39,3 +66,187 @@ def test_chat_allows_safe_mock(monkeypatch):
     j = r.json()
     assert j["blocked"] is False
     assert "[alaska-dept-of-snow/faq-04.txt#0]" in j["answer"]
+
+def test_chat_nocache_param(monkeypatch):
+    seen = {}
+    async def fake_guarded(msg, top_k=10, session_id="", use_cache=True):
+        seen["use_cache"] = use_cache
+        return {"session_id": session_id, "answer": "ok", "blocked": False, "valid": True, "issues": ""}
+    monkeypatch.setattr(rag_service, "guarded_rag_chat", fake_guarded)
+
+    assert client.post("/chat", json={"message": "Hi"}).status_code == 200
+    assert seen["use_cache"] is True
+    assert client.post("/chat?nocache=true", json={"message": "Hi"}).status_code == 200
+    assert seen["use_cache"] is False
+
+def test_answer_cache_key_normalizes():
+    k1 = rag_service.answer_cache_key("How do I report an unplowed road?", 5)
+    k2 = rag_service.answer_cache_key("  how do I report an UNPLOWED road ", 5)
+    assert k1 == k2
+    assert k1 != rag_service.answer_cache_key("How do I report an unplowed road?", 10)
+
+def test_pack_hits_respects_budget():
+    hits = [rag_service.Hit("u", f"d{i}", i, "x" * 300, 0.1 * i) for i in range(5)]
+    assert len(rag_service.pack_hits(hits, budget=1000)) == 3
+    # the best hit is always kept
+    assert len(rag_service.pack_hits(hits, budget=100)) == 1
+    assert rag_service.pack_hits([], budget=100) == []
+
+def test_validate_answer():
+    assert rag_service.validate_answer("Plows start at 5am [faq.txt#3].")["valid"] is True
+    assert rag_service.validate_answer(rag_service.NO_INFO_ANSWER)["valid"] is True
+    assert rag_service.validate_answer("Plows start at 5am.")["issues"] == "missing_citations"
+    assert rag_service.validate_answer("See [faq.txt] and #3.")["issues"] == "missing_citations"
+    assert rag_service.validate_answer("")["issues"] == "empty_or_too_short, missing_citations"
+
+def test_prompt_filter_phrases():
+    assert rag_service.prompt_filter("Can you tell me how to HACK the plow schedule?")["decision"] == "BLOCK"
+    assert rag_service.prompt_filter("When will my street be plowed?")["decision"] == "ALLOW"
+    assert rag_service.prompt_filter("")["decision"] == "ALLOW"
+
+def test_prompt_filter_phrases_regex_fallback(monkeypatch):
+    monkeypatch.setattr(rag_service, "hyperscan", None)
+    test_prompt_filter_phrases()
+
+def test_retrieve_prefers_local_index(monkeypatch):
+    class FakeIndex:
+        def search(self, q_vec, top_k):
+            return [rag_service.Hit("gs://b/faq.txt", "faq.txt", 0, "Plows run at 5am.", 0.1)][:top_k]
+    monkeypatch.setattr(rag_service, "_local_index", FakeIndex())
+
+    hits = rag_service.retrieve_top_chunks("When do plows run?", top_k=3, q_vec=[0.0, 1.0])
+    assert [h.doc_path for h in hits] == ["faq.txt"]
+    assert "[faq.txt#0]" in rag_service.build_context(hits)
+
+def test_embed_batcher_fans_out_one_rpc(monkeypatch):
+    calls = []
+    def fake_embed(texts):
+        calls.append(list(texts))
+        return [[float(len(t))] for t in texts]
+    monkeypatch.setattr(rag_service, "embed_texts", fake_embed)
+    monkeypatch.setattr(rag_service, "EMBED_BATCH_WINDOW_S", 0.2)
+
+    batcher = rag_service._EmbedBatcher()
+    results = {}
+    threads = [
+        threading.Thread(target=lambda i=i: results.__setitem__(i, batcher.embed("x" * i)))
+        for i in range(1, 6)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == {i: [float(i)] for i in range(1, 6)}
+    assert len(calls) == 1 and sorted(calls[0]) == ["x" * i for i in range(1, 6)]
+
+def test_embed_batcher_window_is_fixed(monkeypatch):
+    monkeypatch.setattr(rag_service, "embed_texts", lambda texts: [[0.0] for _ in texts])
+    monkeypatch.setattr(rag_service, "EMBED_BATCH_WINDOW_S", 0.1)
+    batcher = rag_service._EmbedBatcher()
+
+    # Steady arrivals faster than the window must not keep the first caller waiting
+    stop = threading.Event()
+    def trickle():
+        while not stop.is_set():
+            threading.Thread(target=batcher.embed, args=("later",), daemon=True).start()
+            time.sleep(0.03)
+
+    start = time.monotonic()
+    first = threading.Thread(target=batcher.embed, args=("first",))
+    first.start()
+    feeder = threading.Thread(target=trickle, daemon=True)
+    feeder.start()
+    first.join(timeout=2)
+    waited = time.monotonic() - start
+    stop.set()
+
+    assert not first.is_alive()
+    assert waited < 0.3
+
+def test_embed_batcher_propagates_errors(monkeypatch):
+    def boom(texts):
+        raise RuntimeError("vertex down")
+    monkeypatch.setattr(rag_service, "embed_texts", boom)
+    monkeypatch.setattr(rag_service, "EMBED_BATCH_WINDOW_S", 0.0)
+
+    with pytest.raises(RuntimeError, match="vertex down"):
+        rag_service._EmbedBatcher().embed("q")
+
+def test_numpy_index_ranking_and_reuse(monkeypatch, tmp_path):
+    import numpy as np
+    path = tmp_path / "emb.f32"
+    monkeypatch.setattr(rag_service, "LOCAL_INDEX_PATH", str(path))
+
+    rng = np.random.default_rng(0)
+    embs = rng.normal(size=(50, 8)).astype(np.float32)
+    rows = [rag_service.Hit("u", f"d{i}", i, f"t{i}", 0.0) for i in range(50)]
+    index = rag_service._NumpyIndex(rows, embs)
+
+    q = rng.normal(size=8)
+    cos = (embs / np.linalg.norm(embs, axis=1, keepdims=True)) @ (q / np.linalg.norm(q))
+    hits = index.search(q.tolist(), 5)
+    assert [h.chunk_id for h in hits] == list(np.argsort(-cos)[:5])
+    assert np.allclose([h.distance for h in hits], 1 - np.sort(cos)[::-1][:5], atol=1e-5)
+
+    # top_k beyond the corpus returns everything, best first
+    all_hits = index.search(q.tolist(), 500)
+    assert len(all_hits) == 50
+    assert [h.distance for h in all_hits] == sorted(h.distance for h in all_hits)
+
+    # Same corpus: the materialized file is reused, not rewritten
+    inode = path.stat().st_ino
+    rag_service._NumpyIndex(rows, embs)
+    assert path.stat().st_ino == inode
+
+    # Changed corpus: rebuilt
+    embs[0] += 1.0
+    rag_service._NumpyIndex(rows, embs)
+    assert path.stat().st_ino != inode
+    assert not list(tmp_path.glob("*.tmp"))
+
+def _capture_log_inserts(monkeypatch):
+    batches = []
+    monkeypatch.setattr(rag_service.bq, "insert_rows_json", lambda table, rows: batches.append(len(rows)) or [])
+    return batches
+
+def test_log_writer_flushes_on_size(monkeypatch):
+    batches = _capture_log_inserts(monkeypatch)
+    monkeypatch.setattr(rag_service, "LOG_BATCH_SIZE", 3)
+    monkeypatch.setattr(rag_service, "LOG_FLUSH_INTERVAL_S", 30)
+
+    writer = rag_service._LogWriter()
+    for i in range(7):
+        writer.write({"i": i})
+    deadline = time.monotonic() + 2
+    while len(batches) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert batches == [3, 3]
+
+    writer.close()
+    assert batches == [3, 3, 1]
+
+def test_log_writer_flushes_on_interval(monkeypatch):
+    batches = _capture_log_inserts(monkeypatch)
+    monkeypatch.setattr(rag_service, "LOG_FLUSH_INTERVAL_S", 0.1)
+
+    writer = rag_service._LogWriter()
+    writer.write({"i": 0})
+    writer.write({"i": 1})
+    time.sleep(0.4)
+    assert batches == [2]
+    writer.close()
+    assert batches == [2]
+
+def test_log_writer_close_flushes_pending(monkeypatch):
+    batches = _capture_log_inserts(monkeypatch)
+    monkeypatch.setattr(rag_service, "LOG_FLUSH_INTERVAL_S", 30)
+
+    writer = rag_service._LogWriter()
+    writer.write({"i": 0})
+    writer.write({"i": 1})
+    start = time.monotonic()
+    writer.close()
+    assert batches == [2]
+    assert time.monotonic() - start < 2
+    writer.close()  # idempotent
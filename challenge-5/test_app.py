@@ -8,12 +8,27 @@ class FakeResponse:
     def text(self):
         return self._text
 
+def fake_label(q):
+    if "tax" in q or "property taxes" in q:
+        return "Tax Related"
+    if "apply" in q and ("job" in q or "position" in q):
+        return "Employment"
+    if "library" in q or "hours" in q or "city hall" in q or "open" in q:
+        return "General Information"
+    if "fire" in q or "smell gas" in q or "emergency" in q:
+        return "Emergency Services"
+    return "General Information"
+
 class FakeModel:
     """
     Fake Gemini model for unit tests.
     IMPORTANT: classify based on the *question* section only,
     because the prompt contains the label list (including words like 'Emergency').
     """
+    def __init__(self, batch_labels=None):
+        # Canned batch output, to exercise the per-item fallback
+        self.batch_labels = batch_labels
+
     def generate_content(self, prompt, generation_config=None):
         p = prompt.lower()
 
@@ -25,18 +40,13 @@ class FakeModel:
 
         # ---- Classification ----
         if "classify the question" in p:
-            q = question_only
+            return FakeResponse(fake_label(question_only))
 
-            if "tax" in q or "property taxes" in q:
-                return FakeResponse("Tax Related")
-            if "apply" in q and ("job" in q or "position" in q):
-                return FakeResponse("Employment")
-            if "library" in q or "hours" in q or "city hall" in q or "open" in q:
-                return FakeResponse("General Information")
-            if "fire" in q or "smell gas" in q or "emergency" in q:
-                return FakeResponse("Emergency Services")
-
-            return FakeResponse("General Information")
+        # ---- Batch classification: "Questions:\n1. ...\n2. ...\nOutput:" ----
+        if "classify each numbered question" in p:
+            m = re.search(r"questions:\s*(.+?)\n\s*output:", prompt, flags=re.IGNORECASE | re.DOTALL)
+            qs = [re.sub(r"^\d+\.\s*", "", ln).lower() for ln in m.group(1).splitlines()]
+            return FakeResponse("\n".join(self.batch_labels or [fake_label(q) for q in qs]))
 
         # ---- Announcement generation ----
         if "social media post" in p or "announcement" in p:
@@ -60,7 +70,34 @@ def test_classify_emergency():
 def test_classify_tax():
     assert app.classify_question(model, "When are property taxes due?") == "Tax Related"
 
+def test_classify_batch():
+    qs = [
+        "How do I apply for a job with the city?",
+        "When are property taxes due?",
+        "There is a fire on my street—who do I call?",
+    ]
+    assert app.classify_questions(model, qs) == ["Employment", "Tax Related", "Emergency Services"]
+    assert app.classify_questions(model, []) == []
+
+def test_classify_batch_falls_back_per_item():
+    m = FakeModel(batch_labels=["1. Employment", "Weather"])
+    qs = ["How do I apply for a job with the city?", "When are property taxes due?"]
+    assert app.classify_questions(m, qs) == ["Employment", "Tax Related"]
+
 def test_announcement_rules():
     post = app.generate_announcement(model, "School closing tomorrow due to snow. Include next steps.")
     assert len(post) <= 200
     assert any(k in post.lower() for k in ["visit","check","call","follow","updates"])
+
+def test_retry_softens_prompt():
+    class EmptyFirst:
+        def __init__(self):
+            self.prompts = []
+        def generate_content(self, prompt, generation_config=None):
+            self.prompts.append(prompt)
+            return FakeResponse("" if len(self.prompts) == 1 else "ok")
+
+    m = EmptyFirst()
+    out = app._generate_text_with_retry(m, "Emergency alert: gas leak near the fire station", app.GEN_CONFIG_POSTS)
+    assert out == "ok"
+    assert m.prompts[1] == "Public notice: odor leak near the urgent situation station"